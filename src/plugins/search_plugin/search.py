@@ -1,12 +1,11 @@
 import os
 import sqlite3
-import struct
 import time
 
-from qgis.PyQt.QtCore import Qt, QObject, pyqtSignal, QThread, QEvent
+from qgis.PyQt.QtCore import Qt, QObject, pyqtSignal, QThread, QEvent, QTimer
 from qgis.PyQt.QtWidgets import QListWidgetItem
 from qgis.PyQt.uic import loadUiType
-from qgis.core import QgsMapLayer, QgsProject, QgsFeatureRequest
+from qgis.core import QgsMapLayer, QgsProject, QgsFeatureRequest, NULL
 
 import roam.api.utils
 import roam.utils
@@ -21,19 +20,33 @@ def resolve(name):
 
 widget, base = loadUiType(resolve("search.ui"))
 
+# CROSS JOIN pins the join order so the full text match runs first and each match
+# looks up featureinfo by rowid, then layers by rowid (or a scan when there is only
+# one layer). Left to itself the planner scans layers, and for small indexes
+# featureinfo too, before probing the FTS table once per row.
+SEARCH_QUERY = """SELECT layers.name, featureinfo.featureid, snippet(search, '[', ']', '...', -1, 10) as snippet
+                  FROM search
+                  CROSS JOIN featureinfo on search.docid = featureinfo.id
+                  CROSS JOIN layers on featureinfo.layer_id = layers.id
+                  WHERE search MATCH ? LIMIT 100"""
+
 
 def make_rank_func(weights):
     # Taken from http://chipaca.com/post/16877190061/doing-full-text-search-in-sqlite-from-python
+    weights = tuple(weights)
+
     def rank(matchinfo):
         # matchinfo is defined as returning 32-bit unsigned integers
         # in machine byte order
         # http://www.sqlite.org/fts3.html#matchinfo
-        # and struct defaults to machine byte order
-        matchinfo = struct.unpack("I"*(len(matchinfo)/4), matchinfo)
-        it = iter(matchinfo[2:])
-        return sum(x[0]*w/x[1]
-                   for x, w in zip(zip(it, it, it), weights)
-                   if x[1])
+        # and memoryview casts use machine byte order
+        matchinfo = memoryview(matchinfo).cast("I")
+        # Each column has a (hits this row, hits all rows, docs with hits) triple
+        # after the two leading counts. Strided views avoid copying them out.
+        hits, allhits = matchinfo[2::3], matchinfo[3::3]
+        return sum(hit * weight / allhit
+                   for hit, allhit, weight in zip(hits, allhits, weights)
+                   if allhit)
 
     return rank
 
@@ -46,24 +59,59 @@ def __init__(self, indexpath, indexconfig):
         super(IndexBuilder, self).__init__()
         self.indexpath = indexpath
         self.indexconfig = indexconfig
+        self.conn = None
 
     def build_index(self):
+        try:
+            self._build_index()
+        except Exception:
+            roam.utils.exception("Failed to build the search index")
+        finally:
+            # Always let go of the connection, a failed load would otherwise keep
+            # its transaction and exclusive lock open.
+            self.quit()
+
+    def _build_index(self):
         dbpath = os.path.join(self.indexpath, "index.db")
-        self.conn = sqlite3.connect(dbpath)
+        # Opened on the builder thread and only ever used from there.
+        # We manage the transactions ourselves.
+        self.conn = sqlite3.connect(dbpath, isolation_level=None, check_same_thread=True)
         c = self.conn.cursor()
+        # Bulk load settings. The index is rebuilt from scratch every time so
+        # we don't need the durability of the default journal and sync modes.
+        c.executescript("""PRAGMA page_size=4096;
+                           PRAGMA journal_mode=WAL;
+                           PRAGMA synchronous=OFF;
+                           PRAGMA temp_store=MEMORY;
+                           PRAGMA cache_size=-65536;
+                           PRAGMA locking_mode=EXCLUSIVE;""")
         c.execute("DROP TABLE IF EXISTS search")
         c.execute("DROP TABLE IF EXISTS featureinfo")
-        c.execute("CREATE TABLE featureinfo(id INTEGER PRIMARY KEY, layer, featureid)")
+        c.execute("DROP TABLE IF EXISTS layers")
+        c.execute("DROP TABLE IF EXISTS search_text")
+        # Layer names are stored once and referenced by id from each feature.
+        c.execute("CREATE TABLE layers(id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+        c.execute("CREATE TABLE featureinfo(id INTEGER PRIMARY KEY, layer_id INTEGER, featureid INTEGER)")
 
         def get_columns():
             columns = set()
             for config in self.indexconfig.values():
                 for c in config['columns']:
+                    if c == "_id":
+                        roam.utils.warning("Search can't index a field called _id, skipping it")
+                        continue
                     columns.add('"{}"'.format(c))
-            return columns
+            return sorted(columns)
 
         columns = ','.join(get_columns())
-        c.execute("CREATE VIRTUAL TABLE search USING fts4({})".format(columns))
+        # The indexed text lives in a plain content table that the FTS table reads
+        # from, so the values are only stored once. The FTS index is built over it
+        # in one pass once everything is loaded.
+        # The id column is prefixed to make a clash with a field name unlikely, fields
+        # called _id are skipped.
+        c.execute("CREATE TABLE search_text(_id INTEGER PRIMARY KEY, {})".format(columns))
+        # Prefix indexes keep the fuzzy 'abc*' searches off the full term list.
+        c.execute("CREATE VIRTUAL TABLE search USING fts4(content='search_text', {}, prefix='2,3,4')".format(columns))
 
         def get_features():
             rowid = 0
@@ -72,56 +120,110 @@ def get_features():
                     layers = roam.api.utils.layers(layertype=QgsMapLayer.VectorLayer)
                     print(layers)
                     for layer in layers:
-                        for count, layer, fid, data in get_data(layer, config, rowid):
+                        for count, layer_id, fid, columns, values in get_data(layer, config, rowid):
                             rowid = count
-                            yield count, layer, fid, data
+                            yield count, layer_id, fid, columns, values
                 else:
                     try:
                         layer = roam.api.utils.layer_by_name(layername)
                     except IndexError:
                         continue
-                    for count, layer, fid, data in get_data(layer, config, rowid):
+                    for count, layer_id, fid, columns, values in get_data(layer, config, rowid):
                         rowid = count
-                        yield count, layer, fid, data
+                        yield count, layer_id, fid, columns, values
+
+        layer_ids = {}
+
+        def get_layer_id(layername):
+            try:
+                return layer_ids[layername]
+            except KeyError:
+                self.conn.execute("INSERT OR IGNORE INTO layers(name) VALUES(?)", (layername,))
+                layer_id = self.conn.execute("SELECT id FROM layers WHERE name = ?", (layername,)).fetchone()[0]
+                layer_ids[layername] = layer_id
+                return layer_id
 
         def get_data(layer, config, rowid):
-            layerfields = [field.name() for field in layer.fields()]
+            layerfields = layer.fields()
             configfields = config['columns']
             # Pull out the fields that match on the layer and the config:
-            fields = set(layerfields) & set(configfields)
+            fields = sorted((set(field.name() for field in layerfields) & set(configfields)) - {"_id"})
 
             if not fields:
                 return
 
-            for feature in layer.getFeatures():
-                data = {}
-                for field in fields:
-                    value = str(feature[field])
-                    data['"{}"'.format(field)] = str("{}: {}").format(field, value)
-                if not data:
+            # The column order is fixed for the whole layer so the insert can be reused.
+            columns = tuple(f'"{field}"' for field in fields)
+            indexes = [layerfields.indexOf(field) for field in fields]
+            prefixes = [(index, f"{field}: ") for index, field in zip(indexes, fields)]
+            # Only fetch the attributes we index, we never need the geometry here.
+            request = QgsFeatureRequest().setSubsetOfAttributes(indexes).setFlags(QgsFeatureRequest.NoGeometry)
+            layer_id = get_layer_id(layer.name())
+            for feature in layer.getFeatures(request):
+                # Empty values are left out so they don't end up in the index.
+                values = []
+                for index, prefix in prefixes:
+                    value = feature[index]
+                    if value is None or value == NULL or value == "":
+                        values.append(None)
+                    else:
+                        values.append(prefix + str(value))
+                if not any(values):
                     continue
+                values = tuple(values)
                 fid = feature.id()
                 rowid += 1
-                yield rowid, layer.name(), fid, data
+                yield rowid, layer_id, fid, columns, values
 
         start = time.time()
-        for row in get_features():
-            c.execute("INSERT INTO featureinfo(id, layer, featureid) VALUES(?, ?, ?)", (row[0], row[1], row[2]))
-            data = row[3]
-            # HACK
-            fields = ",".join(data.keys())
-            placeholders = "?," * (len(data.values()))
-            placeholders = placeholders.strip(',')
-            query = "INSERT INTO search(docid, {0}) VALUES({1}, {2})".format(fields, row[0], placeholders)
-            c.execute(query, list(data.values()))
-
-        self.conn.commit()
-        self.conn.close()
+        featureinfo_rows = []
+        # Pending content rows keyed by the insert query for their column set.
+        content_rows = {}
+        queries = {}
+
+        def flush():
+            c.executemany("INSERT INTO featureinfo(id, layer_id, featureid) VALUES(?, ?, ?)", featureinfo_rows)
+            featureinfo_rows.clear()
+            for query, rows in content_rows.items():
+                c.executemany(query, rows)
+            content_rows.clear()
+
+        c.execute("BEGIN")
+        for rowid, layer_id, fid, fields, values in get_features():
+            try:
+                query = queries[fields]
+            except KeyError:
+                placeholders = ",".join("?" * (len(fields) + 1))
+                query = "INSERT INTO search_text(_id, {0}) VALUES({1})".format(",".join(fields), placeholders)
+                queries[fields] = query
+            featureinfo_rows.append((rowid, layer_id, fid))
+            content_rows.setdefault(query, []).append((rowid,) + values)
+            if len(featureinfo_rows) >= 1000:
+                flush()
+            # Commit in chunks to keep the WAL file from growing too large.
+            if rowid % 10000 == 0:
+                c.execute("COMMIT")
+                c.execute("BEGIN")
+
+        flush()
+        c.execute("INSERT INTO search(search) VALUES('rebuild')")
+        c.execute("COMMIT")
+
+        # Merge the FTS segments written during the load into a single b-tree
+        # and tidy up the file now that all the data is in.
+        c.execute("INSERT INTO search(search) VALUES('optimize')")
+        c.execute("ANALYZE")
+        c.execute("VACUUM")
+        self.close()
         self.indexBuilt.emit(dbpath, time.time() - start)
-        self.quit()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
 
     def quit(self):
-        self.conn.close()
+        self.close()
         self.finished.emit()
 
 
@@ -145,7 +247,14 @@ def __init__(self, api, parent=None):
         self.api = api
         self.project = None
         self.dbpath = None
-        self.searchbox.textChanged.connect(self.search)
+        self._db = None
+        self._layer_cache = {}
+        # Wait for a pause in typing before running the search.
+        self._debounce = QTimer(self)
+        self._debounce.setSingleShot(True)
+        self._debounce.setInterval(200)
+        self._debounce.timeout.connect(lambda: self.search(self.searchbox.text()))
+        self.searchbox.textChanged.connect(self._debounce.start)
         self.searchbox.installEventFilter(self)
         self.clearButton.pressed.connect(self.searchbox.clear)
         self.resultsView.itemClicked.connect(self.jump_to)
@@ -162,6 +271,11 @@ def fuzzy_changed(self, state):
 
     def index_built(self, dbpath, timing):
         self.dbpath = dbpath
+        self._db = sqlite3.connect(dbpath, check_same_thread=False)
+        self._db.create_function("rank", 1, make_rank_func((1., .1, 0, 0)))
+        self._db.executescript("""PRAGMA journal_mode=WAL;
+                                  PRAGMA cache_size=-32768;
+                                  PRAGMA mmap_size=268435456;""")
         self.resultsView.clear()
         self.searchbox.setEnabled(True)
         print("Index built in: {} seconds".format(timing))
@@ -171,12 +285,6 @@ def eventFilter(self, object, event):
             RoamEvents.openkeyboard.emit()
         return False
 
-    @property
-    def db(self):
-        db = sqlite3.connect(self.dbpath)
-        db.create_function("rank", 1, make_rank_func((1., .1, 0, 0)))
-        return db
-
     def project_loaded(self, project):
         self.project = project
         self.build_index(project)
@@ -184,7 +292,25 @@ def project_loaded(self, project):
     def rebuild_index(self):
         self.build_index(self.project)
 
+    def layer_by_name(self, name):
+        try:
+            return self._layer_cache[name]
+        except KeyError:
+            layer = roam.api.utils.layer_by_name(name)
+            self._layer_cache[name] = layer
+            return layer
+
+    def close_db(self):
+        if self._db:
+            self._db.close()
+            self._db = None
+
     def build_index(self, project):
+        # A pending search would clear the list while the index is rebuilt.
+        self._debounce.stop()
+        # The index builder needs an exclusive lock on the database.
+        self.close_db()
+        self._layer_cache.clear()
         self.searchbox.setEnabled(False)
         self.resultsView.setEnabled(False)
         self.resultsView.addItem("building search index...")
@@ -197,6 +323,13 @@ def build_index(self, project):
             self.resultsView.addItem("Invalid search config found")
             return
 
+        if self.indexthread is not None:
+            # Drop the hook for the old thread so they don't pile up across rebuilds.
+            try:
+                QgsProject.instance().removeAll.disconnect(self.indexthread.quit)
+            except TypeError:
+                pass
+
         self.indexthread = QThread()
         path = os.path.join(os.environ['APPDATA'], "roam", project.name)
 
@@ -218,41 +351,42 @@ def build_index(self, project):
         self.indexthread.start()
 
     def search(self, text):
-        db = self.db
-        c = db.cursor()
         self.resultsView.clear()
         self.resultsView.setEnabled(False)
-        if not text:
+        if not text or not self._db:
             return
 
+        c = self._db.cursor()
+
         if self.fuzzyCheck.isChecked():
             search = "* ".join(text.split()) + "*"
         else:
             search = text
-        query = c.execute("""SELECT layer, featureid, snippet(search, '[',']') as snippet
-                            FROM search
-                            JOIN featureinfo on search.docid = featureinfo.id
-                            WHERE search match '{}' LIMIT 100""".format(search)).fetchall()
-        for layer, featureid, snippet in query:
-            item = QListWidgetItem()
-            text = "{}\n {}".format(layer, snippet.replace('\n', ' '))
-            item.setText(text)
-            item.setData(Qt.UserRole + 1, (layer, featureid, snippet))
-            self.resultsView.addItem(item)
+        query = c.execute(SEARCH_QUERY, (search,))
+        # Hold off repainting and signals until all the results are in.
+        self.resultsView.setUpdatesEnabled(False)
+        self.resultsView.blockSignals(True)
+        try:
+            for layer, featureid, snippet in query:
+                text = "{}\n {}".format(layer, snippet.replace('\n', ' '))
+                item = QListWidgetItem(text, self.resultsView)
+                item.setData(Qt.UserRole + 1, (layer, featureid, snippet))
+        finally:
+            self.resultsView.blockSignals(False)
+            self.resultsView.setUpdatesEnabled(True)
 
         self.resultsView.setEnabled(True)
 
         if self.resultsView.count() == 0:
             self.resultsView.addItem("No Results")
             self.resultsView.setEnabled(False)
-        db.close()
 
     def jump_to(self, item):
         data = item.data(Qt.UserRole + 1)
         if not data:
             return
         layername, fid = data[0], data[1]
-        layer = roam.api.utils.layer_by_name(layername)
+        layer = self.layer_by_name(layername)
         feature = next(layer.getFeatures(QgsFeatureRequest(fid)))
         self.api.mainwindow.showmap()
         self.api.mainwindow.canvas.zoomToFeatureIds(layer, [fid])
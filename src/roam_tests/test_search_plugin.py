@@ -0,0 +1,108 @@
+import sqlite3
+
+import pytest
+from qgis.core import QgsProject, QgsFeature, QgsField, NULL
+from qgis.PyQt.QtCore import QVariant
+
+from plugins.search_plugin.search import make_rank_func, IndexBuilder, SEARCH_QUERY
+from roam_tests.objects import newmemorylayer
+
+
+@pytest.fixture
+def ftsdb():
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE VIRTUAL TABLE docs USING fts4(a, b)")
+    db.executemany("INSERT INTO docs(docid, a, b) VALUES(?, ?, ?)", [
+        (1, "foo bar", "foo"),
+        (2, "baz", "foo foo"),
+        (3, "bar", "baz"),
+    ])
+    yield db
+    db.close()
+
+
+def matchinfo_for(db, query):
+    rows = db.execute("SELECT docid, matchinfo(docs) FROM docs WHERE docs MATCH ? ORDER BY docid", (query,))
+    return dict(rows.fetchall())
+
+
+def test_rank_uses_hits_over_total_hits_per_column(ftsdb):
+    rank = make_rank_func((1., .1))
+    matches = matchinfo_for(ftsdb, "foo")
+    # foo is in column a once overall and in column b three times overall.
+    assert rank(matches[1]) == pytest.approx(1 * 1. / 1 + 1 * .1 / 3)
+    assert rank(matches[2]) == pytest.approx(0 * 1. / 1 + 2 * .1 / 3)
+
+
+def test_rank_skips_columns_without_hits(ftsdb):
+    rank = make_rank_func((1., 1.))
+    matches = matchinfo_for(ftsdb, "bar")
+    # bar never appears in column b so it adds nothing rather than dividing by zero.
+    assert rank(matches[1]) == pytest.approx(.5)
+    assert rank(matches[3]) == pytest.approx(.5)
+
+
+def test_rank_ignores_extra_weights(ftsdb):
+    rank = make_rank_func((1., .1, 0, 0))
+    matches = matchinfo_for(ftsdb, "foo")
+    assert rank(matches[1]) == pytest.approx(1 * 1. / 1 + 1 * .1 / 3)
+
+
+def test_rank_returns_float(ftsdb):
+    rank = make_rank_func((1., .1))
+    matches = matchinfo_for(ftsdb, "foo")
+    assert isinstance(rank(matches[1]), float)
+
+
+@pytest.fixture
+def searchlayer():
+    layer = newmemorylayer()
+    layer.dataProvider().addAttributes([QgsField("name", QVariant.String)])
+    layer.updateFields()
+    features = []
+    for count, name in enumerate(["alpha street", "beta street", NULL, ""]):
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([count, name])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    QgsProject.instance().addMapLayer(layer)
+    yield layer
+    QgsProject.instance().removeMapLayer(layer.id())
+
+
+def build_search_index(path, config):
+    built = []
+    builder = IndexBuilder(path, config)
+    builder.indexBuilt.connect(lambda dbpath, timing: built.append(dbpath))
+    builder.build_index()
+    assert built, "Index failed to build"
+    return sqlite3.connect(built[0])
+
+
+def test_search_index_returns_layer_name_and_feature_id(tmpdir, searchlayer):
+    db = build_search_index(str(tmpdir), {searchlayer.name(): {"columns": ["name"]}})
+    fids = {feature["name"]: feature.id() for feature in searchlayer.getFeatures() if feature["name"]}
+    results = db.execute(SEARCH_QUERY, ("street",)).fetchall()
+    db.close()
+    assert sorted((layer, featureid) for layer, featureid, _ in results) == sorted([
+        ("testlayer", fids["alpha street"]),
+        ("testlayer", fids["beta street"]),
+    ])
+    snippets = [snippet for _, _, snippet in results]
+    assert "name: alpha [street]" in snippets
+
+
+def test_search_index_skips_empty_values(tmpdir, searchlayer):
+    db = build_search_index(str(tmpdir), {searchlayer.name(): {"columns": ["name"]}})
+    # The NULL and empty features have nothing to index so aren't stored at all.
+    assert db.execute("SELECT count(*) FROM featureinfo").fetchone()[0] == 2
+    assert db.execute(SEARCH_QUERY, ("NULL",)).fetchall() == []
+    db.close()
+
+
+def test_search_index_stores_layer_names_once(tmpdir, searchlayer):
+    db = build_search_index(str(tmpdir), {searchlayer.name(): {"columns": ["name"]}})
+    assert db.execute("SELECT name FROM layers").fetchall() == [("testlayer",)]
+    layer_ids = db.execute("SELECT DISTINCT featureinfo.layer_id FROM featureinfo").fetchall()
+    db.close()
+    assert len(layer_ids) == 1